@@ -1,13 +1,15 @@
 import datetime
+import functools
+import itertools
 import time
 import json
 import logging
-import re
+import operator
 import socket
 import sqlite3
 from collections import namedtuple
-from multiprocessing import Queue, Pipe
-from threading import Thread
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 
 
 class LivestatusClient(object):
@@ -30,6 +32,8 @@ class LivestatusClient(object):
                 the number of monitor nodes
         '''
         self.monitors = []
+        self._names = set()
+        self._addresses = set()
         self.parallel = parallel
         self.workers  = workers if self.parallel else 1
         if monitors: self.add_monitors(monitors)
@@ -37,13 +41,12 @@ class LivestatusClient(object):
     def add_monitors(self, monitors):
         '''A helper function for setting self.monitors'''
         if isinstance(monitors, MonitorNode):
-            if all([
-                    monitors.ip in [m.ip for m in self.monitors],
-                    monitors.port in [m.port for m in self.monitors],
-                    ]) \
-                    or monitors.name in [m.name for m in self.monitors]:
+            address = (monitors.ip, monitors.port)
+            if address in self._addresses or monitors.name in self._names:
                 raise ValueError('Duplicate monitor')
             else:
+                self._addresses.add(address)
+                self._names.add(monitors.name)
                 self.monitors.append(monitors)
         elif isinstance(monitors, dict):
             mon = MonitorNode(**monitors)
@@ -69,39 +72,31 @@ class LivestatusClient(object):
             results = QueryResultSet(query, col_types=col_types)
         else:
             results = QueryResultSet(query)
-        mon_queue = Queue()
-        processes = []
-        output = []
-
-        for mon in self.monitors:
-            mon_queue.put((mon, query))
-
-        if self.workers == 0 or self.workers > len(self.monitors):
-            self.workers = len(self.monitors)
-
-        for w in xrange(0,self.workers):
-            parent_conn, child_conn = Pipe()
-            p = Thread(target=monitor_worker, args=(mon_queue, child_conn))
-            p.start()
-            processes.append((p, parent_conn))
-            mon_queue.put('STOP')
-
-        live_procs = self.workers
-        while live_procs > 0:
-            for proc, conn in processes:
-                if not conn.closed:
-                    data = conn.recv()
-                    if data == 'STOP':
-                        live_procs -= 1
-                        conn.close()
-                    else:
-                        results.update(*data)
-
-        for p, conn in processes:
-            p.join()
+        n_workers = min(self.workers or len(self.monitors), len(self.monitors))
+        query_text = query.query_text
+        fetch = lambda mon: self._fetch(mon, query_text)
+
+        # A pool only pays for itself with more than one worker
+        if n_workers <= 1:
+            for mon in self.monitors:
+                results.update(*fetch(mon))
+            return results
+
+        pool = ThreadPool(n_workers)
+        try:
+            for name, data, error in pool.imap_unordered(fetch, self.monitors):
+                results.update(name, data, error)
+        finally:
+            pool.close()
+            pool.join()
 
         return results
 
+    def close(self):
+        '''Closes any connections held open by keepalive monitors'''
+        for monitor in self.monitors:
+            monitor.close()
+
     def exec_sql(self, query, stmt):
         db = self.run(query).to_sqlite()
         return db.execute(stmt)
@@ -117,14 +112,32 @@ class LivestatusClient(object):
                          ls_filters=filters,
                          )
         dt_results = self.run(dt_query)
+        wanted = set(query.columns)
         results = {}
-        for column in query.columns:
-            for row in dt_results.named_tuples:
-                if row.name == column:
-                    results[column] = row.type
-                    break
+        for row in dt_results.named_tuples:
+            if row.name in wanted and row.name not in results:
+                results[row.name] = row.type
         return results
 
+    def _fetch(self, monitor, query_text):
+        '''Runs a GET request against a single monitor node, returning a
+        (monitor name, data, error) tuple suitable for
+        QueryResultSet.update
+        '''
+        data = None
+        error = None
+        try:
+            data, status, length = monitor.run_query(query_text)
+            if data is None or data.strip('\n\t ') == '':
+                error = '{} did not return any data'.format(monitor.name)
+                data = None
+            elif status != 200:
+                error = 'Error {code}: "{msg}"'.format(code=status, msg=data)
+                data = None
+        except Exception as e:
+            error = e.message
+        return monitor.name, data, error
+
     def __repr__(self):
         return '<LivestatusClient parallel: {}>'.format(self.parallel)
 
@@ -134,10 +147,27 @@ class MonitorNode(object):
     query against that monitor
     '''
 
-    def __init__(self, ip, port, name=None):
+    def __init__(self, ip, port, name=None, keepalive=False, timeout=3):
+        '''Constructor for the monitor node
+
+        Args:
+            ip (str): the address of the livestatus endpoint
+            port (int): the port of the livestatus endpoint
+        Kwargs:
+            name (str): a friendly name, which defaults to ip
+            keepalive (bool): if True, queries are sent with
+                'KeepAlive: on' and the connection is reused for
+                subsequent queries until close() is called
+            timeout (float): seconds to wait when connecting to the
+                monitor and when receiving each response
+        '''
         self.ip   = ip
         self.port = port
         self.name = name if name is not None else ip
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self._socket = None
+        self._lock = Lock()
 
     def run_query(self, query):
         '''Perform a query against the monitor node
@@ -148,18 +178,60 @@ class MonitorNode(object):
         Returns:
             result (str)
         '''
+        if not self.keepalive:
+            s = self._connect()
+            try:
+                return self._request(s, query)
+            finally:
+                s.close()
+
+        query += 'KeepAlive: on\n\n'
+        with self._lock:
+            if self._socket is not None:
+                try:
+                    return self._request(self._socket, query, keep_open=True)
+                except MonitorNodeError:
+                    # The monitor may have dropped the connection since
+                    # the last query, so retry once on a new one
+                    self._close_socket()
+            self._socket = self._connect()
+            try:
+                return self._request(self._socket, query, keep_open=True)
+            except MonitorNodeError:
+                self._close_socket()
+                raise
+
+    def close(self):
+        '''Closes the connection kept open by a keepalive monitor'''
+        with self._lock:
+            self._close_socket()
+
+    def _connect(self):
         try:
-            s = SocketHelper(self.ip, self.port, 3)
+            s = SocketHelper(self.ip, self.port, self.timeout)
         except socket.error:
             msg = 'Could not connect to {}:{}'.format(self.ip, self.port)
             raise MonitorNodeError(msg)
+        if self.keepalive:
+            s.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return s
+
+    def _close_socket(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _request(self, s, query, keep_open=False):
         try:
-            s.send_all(query)
+            s.send_all(query, close=not keep_open)
             headers = s.recv_all(16)
-            if len(headers) != 16 or re.match('\d\d\d\s*\d+\s*\n', headers) is None:
+            fields = headers.split()
+            if len(headers) != 16 or headers[-1] != '\n' \
+                    or len(fields) != 2 or len(fields[0]) != 3 \
+                    or not fields[0].isdigit() or not fields[1].isdigit():
                 raise ValueError
-            status = int(headers.split()[0])
-            length = int(headers.split()[1])
+            status = int(fields[0])
+            length = int(fields[1])
         except (socket.error, IndexError, ValueError):
             msg = '{} did not return a proper response header'.format(self.name)
             raise MonitorNodeError(msg)
@@ -233,24 +305,18 @@ class Query(object):
 
         filters = filters if filters is not None else []
         stats = stats if stats is not None else []
-        query = 'GET {req}\n'.format(req=table)
+        parts = ['GET ', table, '\n']
         if columns:
-            query += 'Columns: {cols}\n'.format(
-                cols=' '.join(c for c in columns)
-                )
+            parts += ['Columns: ', ' '.join(columns), '\n']
         for f in filters:
-            if any([
-                    f.startswith('Or:'),
-                    f.startswith('And:'),
-                    f.startswith('Negate:'),
-                    ]):
-                query += f + '\n'
+            if f.startswith(('Or:', 'And:', 'Negate:')):
+                parts += [f, '\n']
             else:
-                query += 'Filter: {filter}\n'.format(filter=f)
+                parts += ['Filter: ', f, '\n']
         for s in stats:
-            query += 'Stats: {s}\n'.format(s=s)
-        query += 'ResponseHeader: fixed16\n'
-        return query
+            parts += ['Stats: ', s, '\n']
+        parts.append('ResponseHeader: fixed16\n')
+        return ''.join(parts)
 
     def __repr__(self):
         return '<Query for {} table>'.format(self.table)
@@ -281,9 +347,9 @@ class QueryResultSet(object):
         self.columns = self.query.columns
 
     def update(self, monitor, data, error):
-        self.results[monitor] = {}
-        self.results[monitor]['data'] = data
-        self.results[monitor]['error'] = error
+        '''Records the data or error returned by a monitor, replacing any
+        earlier record for the same monitor'''
+        self.results[monitor] = {'data': data, 'error': error}
 
     def to_sqlite(self):
         '''Dumps the query results into an sqlite database and returns
@@ -295,7 +361,8 @@ class QueryResultSet(object):
             'float': 'REAL',
             'time': 'REAL' if self.time_format == 'stamp' else 'TEXT'
         }
-        rows = self._parse_data(format='lists',flatten=True)
+        self._resolve_columns()
+        rows = self._iter_rows(format='lists', flatten=True)
         columns = []
         if not self.query.omit_monitor_column:
             columns.append('monitor TEXT')
@@ -307,9 +374,10 @@ class QueryResultSet(object):
             'columns': ', '.join(columns)
         }
         conn = sqlite3.connect(':memory:')
+        # The database only lives in memory, so skip journaling
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
         create_query = 'CREATE TABLE {table}({columns})'.format(**create_kwargs)
-        conn.execute(create_query)
-        conn.commit()
 
         insert_q = 'INSERT INTO {table} VALUES ({params})'.format(
                 table=self.query.table,
@@ -317,12 +385,15 @@ class QueryResultSet(object):
                                  '?' for item in
                                  create_kwargs['columns'].split(',')])
                 )
-        conn.executemany(insert_q, rows)
         error_create = 'CREATE TABLE errors (monitor TEXT, message TXT)'
+        # Python 2's sqlite3 commits before every DDL statement, so the
+        # tables are created first and only the inserts share a transaction
+        conn.execute(create_query)
         conn.execute(error_create)
-        for monitor, error in self.errors.items():
-            conn.execute('INSERT INTO errors VALUES (?,?)', (monitor, error))
-        conn.commit()
+        with conn:
+            conn.executemany(insert_q, rows)
+            conn.executemany('INSERT INTO errors VALUES (?,?)',
+                             self.errors.items())
         return conn
 
     @staticmethod
@@ -332,87 +403,124 @@ class QueryResultSet(object):
     @property
     def json(self):
         '''Serialize results as a json string'''
-        return json.dumps(self.dicts)
+        return json.dumps(self.dicts, default=_json_default)
 
     @property
     def lists(self):
         '''Return a list of lists'''
-        return self._parse_data(format='lists')
+        return self._collect_rows(format='lists')
 
     @property
     def named_tuples(self):
         '''Return a list of namedtuple objects'''
-        parsed = self.dicts
+        parsed = self.lists
         if not self.query.omit_monitor_column:
             fields = ['monitor'] + self.columns
         else:
             fields = self.columns
-        nt_row = namedtuple('Row', fields)
-        return [nt_row(**row) for row in parsed]
+        nt_row = _row_class(tuple(fields))
+        return map(nt_row._make, parsed)
 
     @property
     def dicts(self):
         '''Return a list of dict objects'''
-        return self._parse_data()
+        return self._collect_rows(format='dicts')
 
     @property
     def errors(self):
         '''Returns a dict of monitor names and errors'''
-        errors = {}
-        for monitor in self.results.keys():
-            if self.results[monitor]['error'] is not None:
-                errors[monitor] = self.results[monitor]['error']
-        return errors
+        return dict((monitor, result['error'])
+                    for monitor, result in self.results.iteritems()
+                    if result['error'] is not None)
 
-    def _parse_data(self, format='dicts', flatten=False):
-        '''Private method that parses raw data and returns it in a
-        desired format
+    def _collect_rows(self, format='dicts', flatten=False):
+        '''Private method that returns every parsed row as one list,
+        extending it by a whole monitor's rows at a time'''
+        results = []
+        for rows in self._iter_monitor_rows(format=format, flatten=flatten):
+            results.extend(rows)
+        return results
+
+    def _iter_rows(self, format='dicts', flatten=False):
+        '''Private method that returns an iterator which parses raw data
+        and yields one row at a time in a desired format
 
         Kwargs:
-            format (str): 'dicts' for a list of dict objects, or
-                'lists' for a list of list objects
+            format (str): 'dicts' to yield dict objects, or 'lists' to
+                yield list objects
+            flatten (bool): if True, lists and times are converted to
+                strings suitable for storing in sqlite
         '''
-        results = []
-        for monitor in self.results.keys():
-            data = self.results[monitor]['data']
+        return itertools.chain.from_iterable(
+            self._iter_monitor_rows(format=format, flatten=flatten))
+
+    def _iter_monitor_rows(self, format='dicts', flatten=False):
+        '''Private generator behind _iter_rows which yields a list of
+        parsed rows for each monitor that returned data
+        '''
+        omit_monitor = self.query.omit_monitor_column
+        has_header = self._resolve_columns()
+        columns = self.columns
+        pipeline = self._pipeline(flatten=flatten)
+        column_pipeline = self._column_pipeline(flatten=flatten)
+        for monitor, result in self.results.iteritems():
+            data = result['data']
             if data is None:
                 continue
-            data = data.strip('\n ')
-            rows = data.split('\n')
-            if self.query.columns == []:
-                if len(self.query.stats) > 0:
-                    cols = []
-                    if len(self.query.columns) > 0:
-                        cols.append(self.query.columns[0])
-                    cols.extend(self.query.stats)
-                    self.columns = cols
+            rows = data.strip('\n ').split('\n')
+            if has_header:
+                del(rows[0])
+            if format == 'dicts':
+                cells = self._convert_rows(rows, pipeline, column_pipeline)
+                if omit_monitor:
+                    yield [dict(zip(columns, row)) for row in cells]
                 else:
-                    self.columns = rows[0].split(';')
-                    del(rows[0])
-            else:
-                self.columns = self.query.columns
-            for row in rows:
-                if format == 'dicts':
-                    row_dict = dict(zip(
-                                        self.columns,
-                                        self._apply_filters(row.split(';'))
-                                        ))
-                    row_dict = self._conv_types(row_dict,flatten=flatten)
-                    if not self.query.omit_monitor_column:
-                        row_dict['monitor'] = monitor
-                    results.append(row_dict)
-                elif format == 'lists':
-                    row_list = []
-                    if not self.query.omit_monitor_column:
-                        row_list += [monitor]
-                    items = self._conv_types(row.split(';'),flatten=flatten)
-                    items = self._apply_filters(items)
-                    row_list += items
-                    results.append(row_list)
-        return results
+                    yield [dict(zip(columns, row), monitor=monitor)
+                           for row in cells]
+            elif format == 'lists':
+                lead = [] if omit_monitor else [monitor]
+                yield self._convert_rows(rows, pipeline, column_pipeline, lead)
+
+    def _convert_rows(self, rows, pipeline, column_pipeline, lead=()):
+        '''Private method that splits raw rows into cells and converts
+        them. When every row has one cell per column, the rows are
+        transposed so that each of column_pipeline converts a whole
+        column at once, otherwise each cell goes through pipeline.
+        Every returned row starts with the values in lead
+        '''
+        table = [row.split(';') for row in rows]
+        ncols = len(pipeline)
+        lead = list(lead)
+        if any(len(cells) != ncols for cells in table):
+            return [lead + [func(value) for func, value in zip(pipeline, cells)]
+                    for cells in table]
+        columns = [[value] * len(table) for value in lead]
+        columns += [func(column)
+                    for func, column in zip(column_pipeline, zip(*table))]
+        return [list(row) for row in zip(*columns)]
+
+    def _resolve_columns(self):
+        '''Private method that sets self.columns for the result set
+        before any rows are parsed. Returns True if the column names
+        were taken from a header row in each monitor's data, which
+        livestatus sends when a query selects no columns
+        '''
+        if self.query.columns:
+            self.columns = self.query.columns
+        elif self.query.stats:
+            self.columns = list(self.query.stats)
+        else:
+            for result in self.results.itervalues():
+                if result['data'] is not None:
+                    header = result['data'].strip('\n ').split('\n', 1)[0]
+                    self.columns = header.split(';')
+                    break
+            return True
+        return False
 
-    def _conv_types(self, row, flatten=False):
-        '''Private method used for converting return values from
+    def _converters(self, flatten=False):
+        '''Private method that returns a list of callables, one for
+        each of self.columns, used for converting return values from
         livestatus to their desired python data type
         '''
         converters = {
@@ -429,36 +537,54 @@ class QueryResultSet(object):
         if self.time_format == 'stamp':
             converters['time'] = float
 
-        if isinstance(row, dict):
-            for key, value in row.items():
-                conv = converters.get(self.col_types.get(key), str)
-                row[key] = conv(value)
-            return row
-        elif isinstance(row, list):
-            result = []
-            for key, value in zip(self.columns,row):
-                conv = converters.get(self.col_types.get(key), str)
-                result.append(conv(value))
-            return result
-
-    def _apply_filters(self, result_list):
-        '''Private method that applies filters in
-        QueryResultSet.query.post_filters to all column data
+        return [converters.get(self.col_types.get(column), str)
+                for column in self.columns]
+
+    def _pipeline(self, flatten=False):
+        '''Private method that returns one callable per column which
+        converts a raw value and then applies every filter in
+        QueryResultSet.query.post_filters to it
         '''
-        for f in self.query.post_filters:
-            result_list = map(f, result_list)
-        return result_list
+        post_filters = self.query.post_filters
+        return [_compose(conv, *post_filters)
+                for conv in self._converters(flatten=flatten)]
+
+    def _column_pipeline(self, flatten=False):
+        '''Private method that returns one callable per column which
+        does the work of _pipeline for a whole column of raw values.
+        Time columns are converted in bulk with _convert_times
+        '''
+        post_filters = self.query.post_filters
+        funcs = []
+        for column, conv in zip(self.columns,
+                                self._converters(flatten=flatten)):
+            if self.col_types.get(column) == 'time':
+                func = functools.partial(_convert_times,
+                                         time_format=self.time_format,
+                                         flatten=flatten)
+            else:
+                func = functools.partial(map, conv)
+            if post_filters:
+                post = functools.partial(map, _compose(*post_filters))
+                func = _compose(func, post)
+            funcs.append(func)
+        return funcs
 
     def __len__(self):
-        return len(self.lists)
+        '''Counts rows from the raw data without parsing them'''
+        has_header = self._resolve_columns()
+        count = 0
+        for result in self.results.itervalues():
+            data = result['data']
+            if data is not None:
+                count += data.strip('\n ').count('\n') + 1 - has_header
+        return count
 
     def __add__(self, other):
         if self.query.query_text != other.query.query_text:
             raise TypeError('QueryResultSet queries do not match')
-        for monitor in other.results.keys():
-            self.results[monitor] = {}
-            self.results[monitor]['data'] = other.results[monitor]['data']
-            self.results[monitor]['error'] = other.results[monitor]['error']
+        for monitor, result in other.results.iteritems():
+            self.update(monitor, result['data'], result['error'])
         return self
 
 
@@ -466,7 +592,10 @@ class SocketHelper(object):
     '''A very simple wrapper around the socket class to provide some
     convenience methods and error-handling'''
 
-    CHUNK_SIZE = 1024
+    # Lengths come from the response header, so anything larger than this
+    # is read in chunks rather than trusted for a single allocation
+    PREALLOCATE_LIMIT = 1 << 24
+    CHUNK_SIZE = 65536
 
     def __init__(self, host, port, timeout=5):
         self.host = host
@@ -474,6 +603,8 @@ class SocketHelper(object):
         self.timeout = timeout
         self.socket = socket.create_connection(
                 (self.host, self.port), self.timeout)
+        # Queries are small single writes, don't hold them back for Nagle
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def send_all(self, data, close=True):
         '''Blocks until all data is sent to the socket and closes the socket
@@ -486,46 +617,92 @@ class SocketHelper(object):
         '''Blocks until <msg_len> number of bytes have been received from the
         socket or raises an exception if the connection times out, closing the
         socket afterwards if close is True'''
+        try:
+            if msg_len <= self.PREALLOCATE_LIMIT:
+                return self._recv_into(msg_len)
+            return self._recv_chunks(msg_len)
+        finally:
+            if close:
+                self.socket.close()
+
+    def _recv_into(self, msg_len):
+        '''Receives <msg_len> bytes into a buffer allocated up front'''
+        buf = bytearray(msg_len)
+        view = memoryview(buf)
+        offset = 0
+        start = time.time()
+        while offset < msg_len:
+            received = self.socket.recv_into(view[offset:], msg_len - offset)
+            if not received or time.time() - start > self.timeout:
+                raise socket.error
+            offset += received
+        return bytes(buf)
+
+    def _recv_chunks(self, msg_len):
+        '''Receives <msg_len> bytes through a reusable chunk buffer, so that
+        memory is only used for data that actually arrives'''
         remaining = msg_len
-        chunks = []
+        buf = bytearray()
+        chunk = memoryview(bytearray(self.CHUNK_SIZE))
         start = time.time()
-        failed = False
         while remaining > 0:
-            size = min(remaining, self.CHUNK_SIZE)
-            received = self.socket.recv(size)
-            chunks.append(received)
-            remaining -= len(received)
-            if time.time() - start > self.timeout:
-                failed = True
-                break
-        if close:
-            self.socket.close()
-        if failed:
-            raise socket.error
-        return ''.join(chunks)
+            received = self.socket.recv_into(chunk, min(remaining, self.CHUNK_SIZE))
+            if not received or time.time() - start > self.timeout:
+                raise socket.error
+            buf += chunk[:received]
+            remaining -= received
+        return bytes(buf)
 
+    def close(self):
+        self.socket.close()
 
-def monitor_worker(mon_queue, conn):
-    '''
-    Helper function for retrieving results from multiple monitors in parallel
+
+_ROW_CLASSES = {}
+_ROW_CLASSES_MAX = 128
+
+
+def _row_class(fields):
+    '''Returns a namedtuple class for a tuple of field names, creating one
+    only the first time those fields are seen'''
+    try:
+        return _ROW_CLASSES[fields]
+    except KeyError:
+        if len(_ROW_CLASSES) >= _ROW_CLASSES_MAX:
+            _ROW_CLASSES.clear()
+        cls = _ROW_CLASSES[fields] = namedtuple('Row', fields)
+        return cls
+
+
+def _convert_times(values, time_format='datetime', flatten=False):
+    '''Converts a column of Unix timestamps the same way the 'time'
+    converter in QueryResultSet._converters would, but maps builtins over
+    the whole column so that no Python-level function runs per value
     '''
-    for monitor, query in iter(mon_queue.get, 'STOP'):
-        data = None
-        error = None
-        try:
-            data, status, length = monitor.run_query(query.query_text)
-            if data is None or data.strip('\n\t ') == '':
-                error = '{} did not return any data'.format(monitor.name)
-                data = None
-            elif status != 200:
-                error = 'Error {code}: "{msg}"'.format(code=status, msg=data)
-                data = None
-        except Exception as e:
-            error = e.message
-        finally:
-            conn.send((monitor.name, data, error))
-    conn.send('STOP')
-    return
+    stamps = map(float, values)
+    if time_format == 'stamp':
+        return stamps
+    times = map(datetime.datetime.fromtimestamp, stamps)
+    if flatten:
+        return map(operator.methodcaller('isoformat', ' '), times)
+    return times
+
+
+def _json_default(obj):
+    '''Serializes datetimes as ISO 8601 strings for json.dumps'''
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+def _compose(*funcs):
+    '''Returns a single callable applying each of funcs in order'''
+    if len(funcs) == 1:
+        return funcs[0]
+    def composed(value):
+        for func in funcs:
+            value = func(value)
+        return value
+    return composed
 
 
 class MonitorNodeError(Exception):
@@ -1,8 +1,14 @@
 ### Filters to be run on livestatus data
+import re
+
+
+_NUMBER_RE = re.compile(r'-?\d+(\.\d+)?\Z')
 
 
 def empty_to_nonetype(data):
     '''Return a NoneType object if data is an empty string'''
+    if not isinstance(data, basestring):
+        return data
     data = data.strip('\n\t ')
     if data == '':
         return None
@@ -12,10 +18,12 @@ def empty_to_nonetype(data):
 
 def detect_numbers(data):
     '''Convert data to an int or float if possible'''
-    if data.isdigit():
-        if '.' in data:
-            return float(data)
-        else:
-            return int(data)
-    else:
+    if not isinstance(data, basestring):
+        return data
+    match = _NUMBER_RE.match(data)
+    if match is None:
         return data
+    elif match.group(1):
+        return float(data)
+    else:
+        return int(data)
@@ -1,12 +1,14 @@
-import random
 import socket
-import time
-from multiprocessing import Process
+import threading
+import unittest
+
+
+HEADER_TEMPLATE = '%d %11d\n'
 
 
 class ServerHelper(object):
-    '''A helper object for managing a separate python process with a
-    LiveStatus server running in it
+    '''A helper object for managing a LiveStatus server running in a
+    background thread
     '''
 
     conn = None
@@ -17,13 +19,23 @@ class ServerHelper(object):
 
     def start(self):
         self.host, self.port = self.server.get_sock()
-        self.proc = Process(target=self.server.run)
-        self.proc.start()
+        self.thread = threading.Thread(target=self.server.run)
+        self.thread.daemon = True
+        self.thread.start()
         return self.host, self.port
 
     def stop(self):
-        self.proc.terminate()
-        self.proc.join(1)
+        self.server.stop()
+        self.thread.join(1)
+
+    def reset(self):
+        '''Discards the requests and responses recorded so far, so that a
+        server shared between tests starts each one clean'''
+        s = socket.create_connection((self.host, self.port), 5)
+        s.send('RESET')
+        s.shutdown(socket.SHUT_WR)
+        s.recv(1024)
+        s.close()
 
     def get_last_recv(self):
         s = socket.create_connection((self.host, self.port), 5)
@@ -42,6 +54,155 @@ class ServerHelper(object):
         return msg
 
 
+class FakeSocket(object):
+    '''An in-process stand-in for a connected socket that replays a
+    canned response, for tests that don't need a real server
+
+    Args:
+        response (str): the bytes handed back to the client, in order
+    Kwargs:
+        error (socket.error, None): raised once the response has been
+            read in full, instead of signalling end-of-stream
+    '''
+    def __init__(self, response='', error=None):
+        self.response = response
+        self.error = error
+        self.sent = ''
+        self.closed = False
+        self._offset = 0
+
+    def _read(self, nbytes):
+        data = self.response[self._offset:self._offset + nbytes]
+        if not data and self.error is not None:
+            raise self.error
+        self._offset += len(data)
+        return data
+
+    def recv(self, nbytes):
+        return self._read(nbytes)
+
+    def recv_into(self, buf, nbytes=0):
+        data = self._read(nbytes or len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self.sent += data
+
+    def setsockopt(self, *args):
+        pass
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class SocketBlockedError(AssertionError):
+    '''Raised when a test tries to open a real connection without
+    asking for one, or more connections than its SocketPatch has fake
+    sockets for'''
+
+
+class NetworkGuard(object):
+    '''Blocks real connections by patching socket.socket.connect and
+    connect_ex, which socket.create_connection goes through as well.
+    Every blocked attempt is recorded as well as raised, so that check()
+    can still fail a test whose code under test swallowed the error
+    '''
+    def __init__(self):
+        self.allowed = False
+        self.blocked = []
+        self._methods = None
+
+    def install(self):
+        self._methods = dict((name, vars(socket.socket)[name])
+                             for name in ('connect', 'connect_ex'))
+        for name, method in self._methods.items():
+            setattr(socket.socket, name, self._guard(method))
+
+    def uninstall(self):
+        for name, method in self._methods.items():
+            setattr(socket.socket, name, method)
+        self._methods = None
+
+    def _guard(self, method):
+        def guarded(sock, address):
+            if not self.allowed:
+                self.block(address)
+            return method(sock, address)
+        return guarded
+
+    def block(self, address):
+        self.blocked.append(address)
+        raise SocketBlockedError(
+            'unexpected connection to {}:{}'.format(*address))
+
+    def check(self):
+        '''Raises SocketBlockedError if any connection was blocked since
+        the last check'''
+        blocked, self.blocked = self.blocked, []
+        if blocked:
+            raise SocketBlockedError('unexpected connection to {}'.format(
+                ', '.join('{}:{}'.format(*address) for address in blocked)))
+
+
+network_guard = NetworkGuard()
+
+
+class TestCase(unittest.TestCase):
+    '''Base class for the tests in this package. The network_guard is
+    installed for the length of each test, so real connections are
+    blocked unless allow_network is set, and a blocked connection fails
+    the test even if the library turned it into a monitor error
+    '''
+    allow_network = False
+
+    def run(self, result=None):
+        network_guard.allowed = self.allow_network
+        network_guard.install()
+        self.addCleanup(network_guard.check)
+        try:
+            return super(TestCase, self).run(result)
+        finally:
+            network_guard.uninstall()
+            network_guard.allowed = False
+
+
+class SocketPatch(object):
+    '''Swaps out socket.create_connection so that connections made by
+    the code under test are served by fake sockets instead of the network.
+    Any connection attempt beyond the given sockets is blocked by the
+    network_guard, even in tests that allow the network.
+
+    Args:
+        *sockets: a FakeSocket to hand out, or an exception to raise,
+            for each connection attempt in turn
+    '''
+    def __init__(self, *sockets):
+        self.sockets = list(sockets)
+        self.addresses = []
+        self._create_connection = None
+
+    def start(self):
+        self._create_connection = socket.create_connection
+        socket.create_connection = self.create_connection
+        return self
+
+    def stop(self):
+        socket.create_connection = self._create_connection
+
+    def create_connection(self, address, timeout=None, *args):
+        self.addresses.append(address)
+        if not self.sockets:
+            network_guard.block(address)
+        sock = self.sockets.pop(0)
+        if isinstance(sock, Exception):
+            raise sock
+        return sock
+
+
 class MockLivestatusServer(object):
     '''A helper class for setting up a fake Livestatus endpoint,
     primarily for use with testing the LivestatusClient
@@ -50,42 +211,67 @@ class MockLivestatusServer(object):
     host = '127.0.0.1' # Only bind to localhost
     port = None
     socket = None
+    def __init__(self):
+        self.stopped = threading.Event()
+
     def get_sock(self):
-        '''Helper method that tries to pick a random port to bind to'''
-        for attempt in xrange(10):
-            rand_port = random.randint(2000, 9999)
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.bind((self.host, rand_port))
-                self.socket = s
-                self.socket.listen(5)
-                self.port = rand_port
-                break
-            except Exception as e:
-                print e
-                continue
-        if self.socket is None or self.port is None:
-            raise RuntimeError('Could not create a socket')
-        else:
-            return self.host, self.port
+        '''Helper method that binds to a free port picked by the kernel'''
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.host, 0))
+        s.listen(5)
+        self.socket = s
+        self.port = s.getsockname()[1]
+        return self.host, self.port
+
+    def stop(self):
+        '''Wakes up anything blocked in the server and closes the listening
+        socket, which makes run() return'''
+        self.stopped.set()
+        try:
+            # Closing alone won't interrupt an accept() in another thread
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
+    def accept(self):
+        '''Waits for the next client, returning None once the server has
+        been stopped'''
+        try:
+            client, address = self.socket.accept()
+        except socket.error:
+            return None
+        if self.stopped.is_set():
+            client.close()
+            return None
+        return client
 
     def run(self):
         last_recv = []
         last_send = []
         while True:
-            client, address = self.socket.accept()
-            data = client.recv(4096)
-            if data is not None:
-                if data == 'GET-LAST-RECV':
-                    client.send(last_recv.pop())
+            client = self.accept()
+            if client is None:
+                return
+            try:
+                data = client.recv(4096)
+                if data == 'RESET':
+                    del last_recv[:], last_send[:]
+                elif data == 'GET-LAST-RECV':
+                    client.sendall(last_recv.pop())
                 elif data == 'GET-LAST-SEND':
-                    client.send(last_send.pop())
+                    client.sendall(last_send.pop())
                 else:
                     last_recv.append(data)
                     response = self.make_response(data)
-                    client.send(response)
+                    client.sendall(response)
                     last_send.append(response)
-            client.close()
+            except socket.error:
+                # The client gave up on us, e.g. after timing out
+                pass
+            finally:
+                client.close()
 
     def make_response(self, data):
         '''Method for generating response data to be seint back to the
@@ -113,25 +299,51 @@ class MockLivestatusServer(object):
         '''
         if length is None:
             length = len(response)
-        header = '{status} {length: ^11}\n'.format(status=status,
-                                                     length=length)
-        return header
+        return HEADER_TEMPLATE % (status, length)
 
 
 class WellBehavedServer(MockLivestatusServer):
     '''Returns a proper, well-formed response'''
-    def make_response(self, data):
-        if data.startswith('GET columns\n'):
-            dummy_data = 'col1;string\ncol2;int\ncol3;time\ncol4;list\n'
-        else:
-            dummy_data = 'string1;1;1418675988;1,2,3\n' + \
-                         'string2;2;1418675987;a,b,c\n'
+    COLUMNS_DATA = 'col1;string\ncol2;int\ncol3;time\ncol4;list\n'
+    ROWS_DATA = 'string1;1;1418675988;1,2,3\n' + \
+                'string2;2;1418675987;a,b,c\n'
+    # The responses never change, so the headers are built up front
+    COLUMNS_RESPONSE = HEADER_TEMPLATE % (200, len(COLUMNS_DATA)) + COLUMNS_DATA
+    ROWS_RESPONSE = HEADER_TEMPLATE % (200, len(ROWS_DATA)) + ROWS_DATA
 
+    def make_response(self, data):
+        columns = data.startswith('GET columns\n')
         if 'ResponseHeader: fixed16' in data:
-            header = self.make_header(dummy_data)
-        else:
-            header = ''
-        return header + dummy_data
+            return self.COLUMNS_RESPONSE if columns else self.ROWS_RESPONSE
+        return self.COLUMNS_DATA if columns else self.ROWS_DATA
+
+
+class KeepAliveServer(MockLivestatusServer):
+    '''Serves every request sent over a connection until the client
+    hangs up. The response data holds the number of the connection the
+    request arrived on'''
+    def run(self):
+        connections = 0
+        while True:
+            client = self.accept()
+            if client is None:
+                return
+            connections += 1
+            pending = ''
+            try:
+                while True:
+                    data = client.recv(4096)
+                    if not data:
+                        break
+                    pending += data
+                    while '\n\n' in pending:
+                        request, pending = pending.split('\n\n', 1)
+                        response = 'connection;{}\n'.format(connections)
+                        client.sendall(self.make_header(response) + response)
+            except socket.error:
+                pass
+            finally:
+                client.close()
 
 
 class EmptyResponseServer(MockLivestatusServer):
@@ -142,6 +354,14 @@ class EmptyResponseServer(MockLivestatusServer):
         return header + dummy_data
 
 
+class MalformedHeaderServer(MockLivestatusServer):
+    '''Returns a 16 byte header that does not start with a status code'''
+    def make_response(self, data):
+        dummy_data = 'string1;1\n'
+        header = 'OK {length: ^12}\n'.format(length=len(dummy_data))
+        return header + dummy_data
+
+
 class NoDataServer(MockLivestatusServer):
     '''Returns a completely empty response (no headers)'''
     def make_response(self, data):
@@ -151,19 +371,17 @@ class NoDataServer(MockLivestatusServer):
 class TimeoutServer(MockLivestatusServer):
     '''Accepts connections but never returns a response'''
     def make_response(self, data):
-        while True:
-            time.sleep(60)
-
+        self.stopped.wait()
+        return ''
 
-class DeadServer(MockLivestatusServer):
-    '''This server will shut the socket before you can try to query it'''
-    def run(self):
-        self.socket.close()
 
 class RudeServer(MockLivestatusServer):
     '''This server will shut down the socket after sending some data'''
     def run(self):
-        client, address = self.socket.accept()
+        client = self.accept()
+        if client is None:
+            return
         data = client.recv(4096)
-        client.send('something!')
+        client.sendall('something!')
+        client.close()
         self.socket.close()
@@ -0,0 +1,31 @@
+from . import TestCase
+from livestatus.filters import empty_to_nonetype, detect_numbers
+
+
+class TestFilters(TestCase):
+
+    def test_empty_to_nonetype(self):
+        self.assertIsNone(empty_to_nonetype(''))
+        self.assertIsNone(empty_to_nonetype(' \n\t'))
+        self.assertEqual(empty_to_nonetype('foo'), 'foo')
+
+        # Values already converted from typed columns pass through
+        for value in [None, 0, 7, ['a', 'b']]:
+            self.assertEqual(empty_to_nonetype(value), value)
+
+    def test_detect_numbers(self):
+        self.assertEqual(detect_numbers('12'), 12)
+        self.assertIsInstance(detect_numbers('12'), int)
+        self.assertEqual(detect_numbers('-3'), -3)
+        self.assertEqual(detect_numbers('1.5'), 1.5)
+        self.assertIsInstance(detect_numbers('1.5'), float)
+
+        # Anything that isn't plainly a number is left alone
+        for value in ['', 'foo', '1.', '.5', '1e3', 'nan', ' 1', None, 7]:
+            self.assertEqual(detect_numbers(value), value)
+
+    def test_filter_chain(self):
+        values = ['', '1', 'foo']
+        for f in [empty_to_nonetype, detect_numbers]:
+            values = map(f, values)
+        self.assertEqual(values, [None, 1, 'foo'])
@@ -1,25 +1,39 @@
 import datetime
+import errno
+import os
+import socket
 import unittest
-from . import *
-from livestatus import *
-from multiprocessing import Process
-
-
-class TestLivestatusClientConstruction(unittest.TestCase):
-
-    def setUp(self):
-        self.single_monitor_dict = {
-                'name': 'my-monitor',
-                'ip' : '1.2.3.4',
-                'port': 9999
-                }
-        self.single_monitor_node = MonitorNode(**self.single_monitor_dict)
-        self.other_monitor_dict = {
-                'name': 'my-monitor2',
-                'ip': '4.3.2.1',
-                'port': 9999
-                }
-        self.other_monitor_node = MonitorNode(**self.other_monitor_dict)
+from . import (TestCase, ServerHelper, FakeSocket, SocketPatch,
+               SocketBlockedError, network_guard, WellBehavedServer,
+               EmptyResponseServer, NoDataServer, TimeoutServer, RudeServer)
+from livestatus import LivestatusClient, MonitorNode, Query, QueryResultSet
+
+
+def _assert_monitors(tc, ls, n, msg=None):
+    '''Checks that the client ls holds n MonitorNode objects'''
+    tc.assertEqual(len(ls.monitors), n, msg)
+    for monitor in ls.monitors:
+        tc.assertIsInstance(monitor, MonitorNode, msg)
+
+
+class TestLivestatusClientConstruction(TestCase):
+
+    # The clients under test only read these, so every test can share them
+    single_monitor_dict = {
+            'name': 'my-monitor',
+            'ip' : '1.2.3.4',
+            'port': 9999
+            }
+    other_monitor_dict = {
+            'name': 'my-monitor2',
+            'ip': '4.3.2.1',
+            'port': 9999
+            }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.single_monitor_node = MonitorNode(**cls.single_monitor_dict)
+        cls.other_monitor_node = MonitorNode(**cls.other_monitor_dict)
 
     def test_init_no_args(self):
         # No args/kwargs
@@ -48,71 +62,49 @@ class TestLivestatusClientConstruction(unittest.TestCase):
         self.assertEqual(ls.workers, 5)
 
     def test_init_with_monitors(self):
-        # test instantiating w/ monitor dict
-        ls = LivestatusClient(monitors=self.single_monitor_dict)
-        self.assertEqual(len(ls.monitors), 1)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
-
-        # Instantiate with monitor dict in a list
-        ls = LivestatusClient(monitors=[self.single_monitor_dict])
-        self.assertEqual(len(ls.monitors), 1)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
-
-        # test instantiating w/ MonitorNode object
-        ls = LivestatusClient(monitors=self.single_monitor_node)
-        self.assertEqual(len(ls.monitors), 1)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
+        # A monitor dict or MonitorNode object, alone or in a list
+        for monitors in (self.single_monitor_dict,
+                         [self.single_monitor_dict],
+                         self.single_monitor_node,
+                         [self.single_monitor_node]):
+            ls = LivestatusClient(monitors=monitors)
+            _assert_monitors(self, ls, 1, monitors)
 
         # Test with mixed types
 
         ls = LivestatusClient(monitors=[self.single_monitor_dict,
                                         self.other_monitor_node])
-        self.assertEqual(len(ls.monitors), 2)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
-        self.assertIsInstance(ls.monitors[1], MonitorNode)
+        _assert_monitors(self, ls, 2)
 
 
-class TestLivestatusClientAddMonitors(unittest.TestCase):
+class TestLivestatusClientAddMonitors(TestCase):
 
-    def setUp(self):
-        self.monitor1_as_dict = {
-                'name': 'my-monitor01',
-                'ip'  : '1.2.3.4',
-                'port': 4000
-                }
-        self.monitor1_as_object = MonitorNode(**self.monitor1_as_dict)
-
-        self.monitor2_as_dict = {
-                'name': 'my-monitor02',
-                'ip'  : '1.2.3.5',
-                'port': 4001
-                }
-        self.monitor2_as_object = MonitorNode(**self.monitor2_as_dict)
+    # The clients under test only read these, so every test can share them
+    monitor1_as_dict = {
+            'name': 'my-monitor01',
+            'ip'  : '1.2.3.4',
+            'port': 4000
+            }
+    monitor2_as_dict = {
+            'name': 'my-monitor02',
+            'ip'  : '1.2.3.5',
+            'port': 4001
+            }
 
-    def test_add_single_monitor(self):
-
-        # ...as a dict
-        ls = LivestatusClient()
-        ls.add_monitors(self.monitor1_as_dict)
-        self.assertEqual(len(ls.monitors), 1)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
-
-        # ...as an object
-        ls = LivestatusClient()
-        ls.add_monitors(self.monitor1_as_object)
-        self.assertEqual(len(ls.monitors), 1)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
-
-        # ...as a singleton
-        ls = LivestatusClient()
-        ls.add_monitors([self.monitor1_as_object])
-        self.assertEqual(len(ls.monitors), 1)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
+    @classmethod
+    def setUpClass(cls):
+        cls.monitor1_as_object = MonitorNode(**cls.monitor1_as_dict)
+        cls.monitor2_as_object = MonitorNode(**cls.monitor2_as_dict)
 
-        ls = LivestatusClient()
-        ls.add_monitors([self.monitor1_as_dict])
-        self.assertEqual(len(ls.monitors), 1)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
+    def test_add_single_monitor(self):
+        # ...as a dict, an object, or a singleton list of either
+        for monitors in (self.monitor1_as_dict,
+                         self.monitor1_as_object,
+                         [self.monitor1_as_object],
+                         [self.monitor1_as_dict]):
+            ls = LivestatusClient()
+            ls.add_monitors(monitors)
+            _assert_monitors(self, ls, 1, monitors)
 
     def test_add_multiple_monitors(self):
         
@@ -120,30 +112,47 @@ class TestLivestatusClientAddMonitors(unittest.TestCase):
         ls = LivestatusClient()
         ls.add_monitors([self.monitor1_as_object,
                          self.monitor2_as_object])
-        self.assertEqual(len(ls.monitors), 2)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
-        self.assertIsInstance(ls.monitors[1], MonitorNode)
+        _assert_monitors(self, ls, 2)
 
         # Two objects, mixed types
         ls = LivestatusClient()
         ls.add_monitors([self.monitor1_as_object,
                          self.monitor2_as_dict])
-        self.assertEqual(len(ls.monitors), 2)
-        self.assertIsInstance(ls.monitors[0], MonitorNode)
-        self.assertIsInstance(ls.monitors[1], MonitorNode)
+        _assert_monitors(self, ls, 2)
 
         # If a user tries to add a duplicate monitor, we should raise an error
         ls = LivestatusClient()
         ls.add_monitors(self.monitor1_as_object)
         self.assertRaises(ValueError, ls.add_monitors, self.monitor1_as_dict)
-        self.assertEqual(len(ls.monitors), 1)
+        _assert_monitors(self, ls, 1)
+
+        # Monitors only collide on the same ip *and* port
+        ls = LivestatusClient()
+        ls.add_monitors([
+            MonitorNode('1.2.3.4', 4000, name='a'),
+            MonitorNode('1.2.3.5', 4001, name='b'),
+            MonitorNode('1.2.3.4', 4001, name='c'),
+            ])
+        _assert_monitors(self, ls, 3)
+        self.assertRaises(ValueError, ls.add_monitors,
+                          MonitorNode('1.2.3.4', 4001, name='d'))
+        _assert_monitors(self, ls, 3)
 
 
-class TestLivestatusClientRunQuery(unittest.TestCase):
+class TestLivestatusClientRunQuery(TestCase):
+
+    allow_network = True
     
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerHelper(WellBehavedServer)
+        cls.host, cls.port = cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
     def setUp(self):
-        self.server = ServerHelper(WellBehavedServer)
-        self.host, self.port = self.server.start()
         self.monitor = MonitorNode(self.host, self.port)
 
     def test_return_val(self):
@@ -151,22 +160,46 @@ class TestLivestatusClientRunQuery(unittest.TestCase):
         query = Query('table', ['col1', 'col2', 'col3', 'col4'])
         result = ls.run(query)
       
-        # Make sure we got a QueryResultSet instance back
+        # Make sure we got a QueryResultSet instance back; the query text
+        # itself is checked in test_query.TestQueryWireFormat
         self.assertIsInstance(result, QueryResultSet)
 
-        # Make sure the proper query was received by the livestatus server
-        msg = self.server.get_last_recv()
-        self.assertEqual(query.query_text, msg)
-        
-    def tearDown(self):
-        self.server.stop()
+    def test_parallel_run(self):
+        other = ServerHelper(WellBehavedServer)
+        host, port = other.start()
+        try:
+            ls = LivestatusClient(monitors=[self.monitor,
+                                            MonitorNode(host, port, 'other')],
+                                  parallel=True)
+            result = ls.run(Query('table', ['col1', 'col2', 'col3', 'col4']))
+        finally:
+            other.stop()
+
+        self.assertEqual(result.errors, {})
+        self.assertEqual(sorted(result.results),
+                         sorted([self.monitor.name, 'other']))
+        self.assertEqual(len(result), 4)
+
+    def test_run_keeps_workers(self):
+        ls = LivestatusClient(monitors=self.monitor, parallel=True)
+        ls.run(Query('table', ['col1', 'col2', 'col3', 'col4']))
+        self.assertEqual(ls.workers, 0)
+
+
+class TestLivestatusClientRunQueryWithTypes(TestCase):
+
+    allow_network = True
 
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerHelper(WellBehavedServer)
+        cls.host, cls.port = cls.server.start()
 
-class TestLivestatusClientRunQueryWithTypes(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
 
     def setUp(self):
-        self.server = ServerHelper(WellBehavedServer)
-        self.host, self.port = self.server.start()
         self.monitor = MonitorNode(self.host, self.port)
 
     def test_auto_detect_types(self):
@@ -215,15 +248,20 @@ class TestLivestatusClientRunQueryWithTypes(unittest.TestCase):
             self.assertIsInstance(row['col4'], list)
 
 
-    def tearDown(self):
-        self.server.stop()
+class TestLivestatusClientEmptyResponse(TestCase):
+
+    allow_network = True
 
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerHelper(EmptyResponseServer)
+        cls.host, cls.port = cls.server.start()
 
-class TestLivestatusClientEmptyResponse(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
 
     def setUp(self):
-        self.server = ServerHelper(EmptyResponseServer)
-        self.host, self.port = self.server.start()
         self.monitor = MonitorNode(self.host, self.port)
 
     def test_return_val(self):
@@ -231,8 +269,6 @@ class TestLivestatusClientEmptyResponse(unittest.TestCase):
         query = Query('table', ['col1', 'col2'])
         result = ls.run(query)
 
-        msg = self.server.get_last_recv()
-        self.assertEqual(query.query_text, msg)
         self.assertIsInstance(result, QueryResultSet)
 
         # There should be an error if livestatus returns no data
@@ -240,11 +276,10 @@ class TestLivestatusClientEmptyResponse(unittest.TestCase):
         expected_error = self.host + ' did not return any data'
         self.assertEqual(expected_error, result.errors[self.monitor.name])
 
-    def tearDown(self):
-        self.server.stop()
 
+class TestLivestatusClientNoResponse(TestCase):
 
-class TestLivestatusClientNoResponse(unittest.TestCase):
+    allow_network = True
     
     def setUp(self):
         self.server = ServerHelper(NoDataServer)
@@ -265,12 +300,14 @@ class TestLivestatusClientNoResponse(unittest.TestCase):
         self.server.stop()
 
 
-class TestLivestatusClientTimeout(unittest.TestCase):
+class TestLivestatusClientTimeout(TestCase):
 
     def setUp(self):
-        self.server = ServerHelper(TimeoutServer)
-        self.host, self.port = self.server.start()
-        self.monitor = MonitorNode(self.host, self.port)
+        # The read times out straight away rather than after the
+        # monitor's timeout
+        timeout = FakeSocket(error=socket.timeout('timed out'))
+        self.patch = SocketPatch(timeout).start()
+        self.monitor = MonitorNode('1.2.3.4', 9999)
 
     def test_monitor_timeout(self):
         ls = LivestatusClient(monitors=self.monitor)
@@ -281,29 +318,60 @@ class TestLivestatusClientTimeout(unittest.TestCase):
         self.assertEqual(expected_error, result.errors[self.monitor.name])
 
     def tearDown(self):
-        self.server.stop()
+        self.patch.stop()
 
 
-class TestLivestatusClientNoConnection(unittest.TestCase):
-    
+@unittest.skipUnless(os.environ.get('LIVESTATUS_NETWORK_TESTS'),
+                     'set LIVESTATUS_NETWORK_TESTS to wait on a real server')
+class TestLivestatusClientTimeoutNetwork(TestLivestatusClientTimeout):
+    '''Waits out a real timeout against a TimeoutServer'''
+
+    allow_network = True
+
     def setUp(self):
         self.server = ServerHelper(TimeoutServer)
         self.host, self.port = self.server.start()
         self.monitor = MonitorNode(self.host, self.port)
 
-    def test_monitor_timeout(self):
+    def tearDown(self):
+        self.server.stop()
+
+
+class TestLivestatusClientNoConnection(TestCase):
+
+    def setUp(self):
+        refused = socket.error(errno.ECONNREFUSED, 'Connection refused')
+        self.patch = SocketPatch(refused).start()
+        self.monitor = MonitorNode('1.2.3.4', 9999)
+
+    def test_monitor_refused(self):
         ls = LivestatusClient(monitors=self.monitor)
         query = Query('table', ['col1', 'col2'])
         result = ls.run(query)
 
-        expected_error = '{} did not return a proper response header'.format(self.monitor.name)
+        expected_error = 'Could not connect to 1.2.3.4:9999'
         self.assertEqual(expected_error, result.errors[self.monitor.name])
 
     def tearDown(self):
-        self.server.stop()
+        self.patch.stop()
+
+
+class TestLivestatusClientBlockedConnection(TestCase):
+
+    def test_blocked_connection_not_swallowed(self):
+        ls = LivestatusClient(monitors=MonitorNode('1.2.3.4', 9999))
+        result = ls.run(Query('table', ['col1', 'col2']))
+
+        # The client reports the blocked connection as a monitor error,
+        # but the guard still knows about it
+        self.assertEqual(result.errors,
+                         {'1.2.3.4': 'unexpected connection to 1.2.3.4:9999'})
+        self.assertRaises(SocketBlockedError, network_guard.check)
+
 
+class TestLivestatusClientIncomplete(TestCase):
 
-class TestLivestatusClientIncomplete(unittest.TestCase):
+    allow_network = True
 
     def setUp(self):
         self.server = ServerHelper(RudeServer)
@@ -1,9 +1,17 @@
 from . import *
 from livestatus import *
+import errno
+import os
 import unittest
 
 
-class TestMonitorNodeConstruction(unittest.TestCase):
+QUERY_TEXT = 'GET services\n' \
+             'Columns: col1 col2 col3 col4\n' \
+             'Filter: state != 0\n' \
+             'ResponseHeader: fixed16\n'
+
+
+class TestMonitorNodeConstruction(TestCase):
 
     def test_init(self):
         mn = MonitorNode('1.2.3.4', 9999)
@@ -11,22 +19,29 @@ class TestMonitorNodeConstruction(unittest.TestCase):
         self.assertEqual(mn.ip, '1.2.3.4')
         self.assertEqual(mn.name, '1.2.3.4')
         self.assertEqual(mn.port, 9999)
+        self.assertFalse(mn.keepalive)
+        self.assertEqual(mn.timeout, 3)
 
+        mn = MonitorNode('1.2.3.4', 9999, timeout=0.5)
+        self.assertEqual(mn.timeout, 0.5)
 
-class TestMonitorQuery(unittest.TestCase):
+
+class TestMonitorQuery(TestCase):
 
     def setUp(self):
-        self.server = ServerHelper(WellBehavedServer)
-        self.host, self.port = self.server.start()
-        self.monitor = MonitorNode(self.host, self.port)
+        self.monitor = MonitorNode('127.0.0.1', 6557)
+        self.patch = None
 
-    def test_good_query(self):
-        query_text = 'GET services\n' + \
-                     'Columns: col1 col2 col3 col4\n' + \
-                     'Filter: state != 0\n' + \
-                     'ResponseHeader: fixed16\n'
+    def serve(self, response):
+        self.sock = FakeSocket(response)
+        self.patch = SocketPatch(self.sock).start()
 
-        data, status, length = self.monitor.run_query(query_text)
+    def last_recv(self):
+        return self.sock.sent
+
+    def test_good_query(self):
+        self.serve(WellBehavedServer.ROWS_RESPONSE)
+        data, status, length = self.monitor.run_query(QUERY_TEXT)
 
         # Did we get all the right types back?
         self.assertIsInstance(data, str)
@@ -34,120 +49,201 @@ class TestMonitorQuery(unittest.TestCase):
         self.assertIsInstance(length, int)
 
         # Ded we send the right data?
-        recvd = self.server.get_last_recv()
-        self.assertEqual(query_text, recvd)
+        recvd = self.last_recv()
+        self.assertEqual(QUERY_TEXT, recvd)
 
         # Did we get the right data back?
         self.assertEqual(data, 'string1;1;1418675988;1,2,3\nstring2;2;1418675987;a,b,c\n')
         self.assertEqual(status, 200)
         self.assertEqual(length, len(data))
 
+    def test_good_query_chunked(self):
+        query_text = 'GET services\n' + \
+                     'Columns: col1 col2 col3 col4\n' + \
+                     'ResponseHeader: fixed16\n'
+
+        self.serve(WellBehavedServer.ROWS_RESPONSE)
+        # Force responses longer than 8 bytes down the chunked read path
+        limit, chunk_size = SocketHelper.PREALLOCATE_LIMIT, SocketHelper.CHUNK_SIZE
+        SocketHelper.PREALLOCATE_LIMIT, SocketHelper.CHUNK_SIZE = 8, 8
+        try:
+            data, status, length = self.monitor.run_query(query_text)
+        finally:
+            SocketHelper.PREALLOCATE_LIMIT, SocketHelper.CHUNK_SIZE = limit, chunk_size
+
+        self.assertEqual(data, 'string1;1;1418675988;1,2,3\nstring2;2;1418675987;a,b,c\n')
+        self.assertEqual(status, 200)
+
     def test_query_without_headers(self):
         query_text = 'GET services\n' + \
                      'Columns: col1 col2 col3 col4\n' + \
                      'Filter: state != 0\n'
 
+        self.serve(WellBehavedServer.ROWS_DATA)
         self.assertRaises(MonitorNodeError, self.monitor.run_query,
                           query_text)
 
     def tearDown(self):
-        self.server.stop()
+        if self.patch is not None:
+            self.patch.stop()
+
 
+@unittest.skipUnless(os.environ.get('LIVESTATUS_NETWORK_TESTS'),
+                     'set LIVESTATUS_NETWORK_TESTS to query a real server')
+class TestMonitorQueryNetwork(TestMonitorQuery):
+    '''Runs the TestMonitorQuery cases against a real WellBehavedServer'''
 
-class TestEmptyResponse(unittest.TestCase):
+    allow_network = True
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerHelper(WellBehavedServer)
+        cls.host, cls.port = cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
 
     def setUp(self):
-        self.server = ServerHelper(EmptyResponseServer)
-        self.host, self.port = self.server.start()
+        self.server.reset()
         self.monitor = MonitorNode(self.host, self.port)
-        self.query_text = 'GET services\n' + \
-                          'Columns: col1 col2 col3 col4\n' + \
-                          'Filter: state != 0\n' + \
-                          'ResponseHeader: fixed16\n'
 
-    def test_empty_response(self):
-        data, status, length = self.monitor.run_query(self.query_text)
-       
-        self.assertEqual(data, '')
-        self.assertEqual(status, 200)
-        self.assertEqual(length, 0)
+    def serve(self, response):
+        # The server builds its own response from the query
+        pass
+
+    def last_recv(self):
+        return self.server.get_last_recv()
 
     def tearDown(self):
-        self.server.stop()
+        pass
 
 
-class TestNoData(unittest.TestCase):
+class TestSocketPatch(TestCase):
 
-    def setUp(self):
-        self.server = ServerHelper(NoDataServer)
-        self.host, self.port = self.server.start()
-        self.monitor = MonitorNode(self.host, self.port)
-        self.query_text = 'GET services\n' + \
-                          'Columns: col1 col2 col3 col4\n' + \
-                          'Filter: state != 0\n' + \
-                          'ResponseHeader: fixed16\n'
+    def test_unexpected_connection_blocked(self):
+        patch = SocketPatch().start()
+        try:
+            monitor = MonitorNode('127.0.0.1', 6557)
+            self.assertRaises(SocketBlockedError, monitor.run_query,
+                              'GET services\n')
+        finally:
+            patch.stop()
+        self.assertEqual(patch.addresses, [('127.0.0.1', 6557)])
+        # The attempt was recorded, and would fail the test if left
+        self.assertRaises(SocketBlockedError, network_guard.check)
 
-    def test_no_data(self):
+    def test_real_connection_blocked(self):
+        monitor = MonitorNode('127.0.0.1', 6557)
+        self.assertRaises(SocketBlockedError, monitor.run_query,
+                          'GET services\n')
+        self.assertRaises(SocketBlockedError, network_guard.check)
 
-        self.assertRaises(MonitorNodeError, self.monitor.run_query,
-                          self.query_text)
-        
-    def tearDown(self):
-        self.server.stop()
+    def test_raw_connect_blocked(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.assertRaises(SocketBlockedError, s.connect,
+                              ('127.0.0.1', 6557))
+            self.assertRaises(SocketBlockedError, s.connect_ex,
+                              ('127.0.0.1', 6557))
+        finally:
+            s.close()
+        self.assertRaises(SocketBlockedError, network_guard.check)
 
 
-class TestTimeout(unittest.TestCase):
+class TestNetworkGuardScope(unittest.TestCase):
+    # A plain TestCase, so this runs without the guard installed
 
-    def setUp(self):
-        self.server = ServerHelper(TimeoutServer)
-        self.host, self.port = self.server.start()
-        self.monitor = MonitorNode(self.host, self.port)
+    def test_not_installed_outside_package_tests(self):
+        self.assertIsNone(network_guard._methods)
+        self.assertEqual(socket.socket.connect.__name__, 'connect')
 
-        self.query_text = 'GET services\n' + \
-                          'Columns: col1 col2 col3 col4\n' + \
-                          'Filter: state != 0\n' + \
-                          'ResponseHeader: fixed16\n'
 
-    def test_monitor_timeout(self):
-        self.assertRaises(MonitorNodeError, self.monitor.run_query,
-                          self.query_text)
-    def tearDown(self):
-        self.server.stop()
-    
+class TestKeepAlive(TestCase):
 
-class TestDeadServer(unittest.TestCase):
+    allow_network = True
 
     def setUp(self):
-        self.server = ServerHelper(DeadServer)
-        self.host, self.port = self.server.start()
-        self.monitor = MonitorNode(self.host, self.port)
-
         self.query_text = 'GET services\n' + \
                           'Columns: col1 col2 col3 col4\n' + \
-                          'Filter: state != 0\n' + \
                           'ResponseHeader: fixed16\n'
-    def test_no_connection(self):
-        self.assertRaises(MonitorNodeError, self.monitor.run_query,
-                          self.query_text)
-
-    def tearDown(self):
-        self.server.stop()
-
 
-class TestRudeServer(unittest.TestCase):
+    def test_connection_reused(self):
+        server = ServerHelper(KeepAliveServer)
+        host, port = server.start()
+        monitor = MonitorNode(host, port, keepalive=True)
+        try:
+            for i in range(3):
+                data, status, length = monitor.run_query(self.query_text)
+                self.assertEqual(status, 200)
+                self.assertEqual(data, 'connection;1\n')
+
+            # A closed monitor opens a new connection for the next query
+            monitor.close()
+            data, status, length = monitor.run_query(self.query_text)
+            self.assertEqual(data, 'connection;2\n')
+        finally:
+            monitor.close()
+            server.stop()
+
+    def test_reconnect_after_hangup(self):
+        # WellBehavedServer closes the connection after every response
+        server = ServerHelper(WellBehavedServer)
+        host, port = server.start()
+        monitor = MonitorNode(host, port, keepalive=True)
+        try:
+            for i in range(2):
+                data, status, length = monitor.run_query(self.query_text)
+                self.assertEqual(status, 200)
+                recvd = server.get_last_recv()
+                self.assertEqual(recvd, self.query_text + 'KeepAlive: on\n\n')
+        finally:
+            monitor.close()
+            server.stop()
+
+
+class TestEmptyResponse(TestCase):
 
     def setUp(self):
-        self.server = ServerHelper(RudeServer)
-        self.host, self.port = self.server.start()
-        self.monitor = MonitorNode(self.host, self.port)
+        response = EmptyResponseServer().make_response('')
+        self.patch = SocketPatch(FakeSocket(response)).start()
+        self.monitor = MonitorNode('127.0.0.1', 6557)
 
-        self.query_text = 'GET services\n' + \
-                          'Columns: col1 col2 col3 col4\n' + \
-                          'Filter: state != 0\n' + \
-                          'ResponseHeader: fixed16\n'
+    def test_empty_response(self):
+        data, status, length = self.monitor.run_query(QUERY_TEXT)
+
+        self.assertEqual(data, '')
+        self.assertEqual(status, 200)
+        self.assertEqual(length, 0)
 
-    def test_connection_hung_up(self):
-        self.assertRaises(MonitorNodeError, self.monitor.run_query,
-                          self.query_text)
     def tearDown(self):
-        self.server.stop()
+        self.patch.stop()
+
+
+class TestErrorResponses(TestCase):
+
+    # What the monitor's connection attempt gets back: a FakeSocket to
+    # read from, or the error raised instead of connecting
+    CASES = {
+        'malformed header': lambda: FakeSocket(
+            MalformedHeaderServer().make_response('')),
+        'no data': lambda: FakeSocket(''),
+        'timeout': lambda: FakeSocket(error=socket.timeout('timed out')),
+        'dead server': lambda: socket.error(errno.ECONNREFUSED,
+                                            'Connection refused'),
+        'hung up': lambda: FakeSocket('something!'),
+        }
+
+    def test_error_responses(self):
+        for case, make_socket in sorted(self.CASES.items()):
+            patch = SocketPatch(make_socket()).start()
+            try:
+                monitor = MonitorNode('127.0.0.1', 6557)
+                try:
+                    monitor.run_query(QUERY_TEXT)
+                except MonitorNodeError:
+                    pass
+                else:
+                    self.fail('{}: MonitorNodeError not raised'.format(case))
+            finally:
+                patch.stop()
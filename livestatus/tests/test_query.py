@@ -1,8 +1,39 @@
-import unittest
+from . import TestCase
 from livestatus import Query
 
 
-class TestQueryConstruction(unittest.TestCase):
+EXPECTED_NO_KWARGS = 'GET table\n' \
+                     'ResponseHeader: fixed16\n'
+EXPECTED_COLUMNS = 'GET table\n' \
+                   'Columns: col1 col2\n' \
+                   'ResponseHeader: fixed16\n'
+EXPECTED_FILTERS = 'GET table\n' \
+                   'Columns: col1 col2\n' \
+                   'Filter: 1 = 2\n' \
+                   'ResponseHeader: fixed16\n'
+EXPECTED_SPECIAL_FILTERS = 'GET table\n' \
+                           'Columns: col1 col2\n' \
+                           'Filter: 1 = 2\n' \
+                           'Filter: 3 = 4\n' \
+                           'Or: 2\n' \
+                           'ResponseHeader: fixed16\n'
+EXPECTED_STATS = 'GET table\n' \
+                 'Stats: state != 0\n' \
+                 'ResponseHeader: fixed16\n'
+
+EXPECTED_WIRE_FORMAT = 'GET table\n' \
+                       'Columns: col1 col2 col3 col4\n' \
+                       'ResponseHeader: fixed16\n'
+
+# (Query args, expected query text)
+BUILD_CASES = [
+    (('table',), EXPECTED_NO_KWARGS),
+    (('table', ['col1', 'col2']), EXPECTED_COLUMNS),
+    (('table', ['col1', 'col2'], ['1 = 2']), EXPECTED_FILTERS),
+    ]
+
+
+class TestQueryConstruction(TestCase):
 
     def test_init(self):
         q = Query('table')
@@ -15,49 +46,39 @@ class TestQueryConstruction(unittest.TestCase):
         self.assertFalse(q.auto_detect_types)
 
 
-class TestQueryBuilder(unittest.TestCase):
+class TestQueryBuilder(TestCase):
 
     def test_build(self):
-
-        # No kwargs
-        q = Query('table')
-        expected = 'GET table\n' + \
-                   'ResponseHeader: fixed16\n'
-        self.assertEqual(q.query_text, expected)
-
-        # Columns
-        q = Query('table', ['col1','col2'])
-        expected = 'GET table\n' + \
-                   'Columns: col1 col2\n' + \
-                   'ResponseHeader: fixed16\n'
-        self.assertEqual(q.query_text, expected)
-
-        # Columns and filters:
-        q = Query('table', ['col1', 'col2'], ['1 = 2'])
-        expected = 'GET table\n' + \
-                   'Columns: col1 col2\n' + \
-                   'Filter: 1 = 2\n' + \
-                   'ResponseHeader: fixed16\n'
-        self.assertEqual(q.query_text, expected)
+        for args, expected in BUILD_CASES:
+            self.assertEqual(Query(*args).query_text, expected)
 
     def test_build_special_filters(self):
         q = Query('table', ['col1', 'col2'],
                   ['1 = 2', '3 = 4', 'Or: 2'])
-
-        expected = 'GET table\n' + \
-                   'Columns: col1 col2\n' + \
-                   'Filter: 1 = 2\n' + \
-                   'Filter: 3 = 4\n' + \
-                   'Or: 2\n' + \
-                   'ResponseHeader: fixed16\n'
-
-        self.assertEqual(expected, q.query_text)
+        self.assertEqual(EXPECTED_SPECIAL_FILTERS, q.query_text)
 
     def test_build_stats(self):
         q = Query('table', stats=['state != 0'])
-        expected = 'GET table\nStats: state != 0\nResponseHeader: fixed16\n'
-        self.assertEqual(expected, q.query_text)
+        self.assertEqual(EXPECTED_STATS, q.query_text)
 
         self.assertRaises(ValueError, Query.__init__, q, 'table',
                           columns=['col1','col2'],
                           stats=['state = 0', 'state = 1'])
+
+    def test_query_text_follows_changes(self):
+        q = Query('table', ['col1'])
+
+        # Changing the query changes the text sent for it
+        q.columns.append('col2')
+        self.assertEqual(q.query_text, EXPECTED_COLUMNS)
+
+        q.ls_filters = ['1 = 2']
+        self.assertIn('Filter: 1 = 2\n', q.query_text)
+
+
+class TestQueryWireFormat(TestCase):
+
+    def test_wire_format(self):
+        # The exact text LivestatusClient sends to each monitor
+        q = Query('table', ['col1', 'col2', 'col3', 'col4'])
+        self.assertEqual(q.query_text, EXPECTED_WIRE_FORMAT)
@@ -1,24 +1,32 @@
+import json
 import sqlite3
-import unittest
 from collections import namedtuple
+from . import TestCase
 from livestatus import QueryResultSet, Query
+from livestatus.filters import empty_to_nonetype
 
 
-class TestQueryResultMinArgs(unittest.TestCase):
+class TestQueryResultMinArgs(TestCase):
+
+    # Read-only fixtures shared by every test; only the result set is
+    # rebuilt, since most tests update it
+    monitor1 = {
+            'monitor' : 'my-monitor01',
+            'data'    : 'col1;col2;col3\nn1;n2;n3\n',
+            'error'   : None
+            }
+    monitor2 = {
+            'monitor' : 'my-monitor02',
+            'data'    : None,
+            'error'   : 'my-monitor02 did not respond'
+            }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.q = Query('some_table')
 
     def setUp(self):
-        self.q = Query('some_table')
         self.result_set = QueryResultSet(self.q)
-        self.monitor1 = {
-                'monitor' : 'my-monitor01',
-                'data'    : 'col1;col2;col3\nn1;n2;n3\n',
-                'error'   : None
-                }
-        self.monitor2 = {
-                'monitor' : 'my-monitor02',
-                'data'    : None,
-                'error'   : 'my-monitor02 did not respond'
-                }
 
     def test_constructor(self):
 
@@ -41,6 +49,17 @@ class TestQueryResultMinArgs(unittest.TestCase):
         self.assertEqual(self.result_set.results[self.monitor2['monitor']],
                          expected)
 
+        # A second update for a monitor replaces its earlier record
+        self.result_set.update('my-monitor02', 'col1;col2;col3\n', None)
+        self.assertEqual(len(self.result_set.results), 2)
+        self.assertEqual(self.result_set.results['my-monitor02'],
+                         {'data': 'col1;col2;col3\n', 'error': None})
+
+        # results is the result set's storage, so edits to it are kept
+        result = self.result_set.results['my-monitor02']
+        result['data'] = 'col1;col2;col3\na;b;c\n'
+        self.assertIn(['my-monitor02', 'a', 'b', 'c'], self.result_set.lists)
+
     def test_result_parsing(self):
         self.result_set.update(**self.monitor1)
         self.result_set.update(**self.monitor2)
@@ -76,3 +95,113 @@ class TestQueryResultMinArgs(unittest.TestCase):
         self.assertIsInstance(db, sqlite3.Connection)
         rows = db.execute('SELECT * FROM some_table').fetchall()
         self.assertEqual(len(rows), 1)
+
+    def test_post_filters_after_conversion(self):
+        q = Query('some_table', ['col1', 'col2'],
+                  post_filters=[lambda x: None if x == '' else x])
+        result_set = QueryResultSet(q, col_types={'col2': 'int'})
+        result_set.update('my-monitor01', 'n1;1\n;2\n', None)
+
+        # Filters see converted values, and both formats agree
+        self.assertEqual(result_set.lists,
+                         [['my-monitor01', 'n1', 1],
+                          ['my-monitor01', None, 2]])
+        self.assertEqual([(row['col1'], row['col2'])
+                          for row in result_set.dicts],
+                         [('n1', 1), (None, 2)])
+
+    def test_empty_to_nonetype_with_typed_columns(self):
+        q = Query('some_table', ['a', 'b', 'c'],
+                  post_filters=[empty_to_nonetype])
+        result_set = QueryResultSet(q, col_types={'b': 'int', 'c': 'list'})
+        result_set.update('my-monitor01', 'x;1;p,q\n;2;r\n', None)
+
+        expected = [{'monitor': 'my-monitor01', 'a': 'x', 'b': 1,
+                     'c': ['p', 'q']},
+                    {'monitor': 'my-monitor01', 'a': None, 'b': 2,
+                     'c': ['r']}]
+        self.assertEqual(result_set.dicts, expected)
+        self.assertEqual(json.loads(result_set.json), expected)
+
+    def test_header_row_per_monitor(self):
+        self.result_set.update(**self.monitor1)
+        self.result_set.update('my-monitor03', 'col1;col2;col3\nm1;m2;m3\n',
+                               None)
+
+        self.assertEqual(self.result_set.columns, [])
+        self.assertEqual(sorted(self.result_set.lists),
+                         [['my-monitor01', 'n1', 'n2', 'n3'],
+                          ['my-monitor03', 'm1', 'm2', 'm3']])
+        self.assertEqual(self.result_set.columns, ['col1', 'col2', 'col3'])
+
+    def test_json_with_times(self):
+        q = Query('some_table', ['col1', 'col2'], omit_monitor_column=True)
+        result_set = QueryResultSet(q, col_types={'col2': 'time'})
+        result_set.update('my-monitor01', 'n1;1418675988\n', None)
+
+        expected = result_set.dicts[0]['col2'].isoformat()
+        self.assertEqual(json.loads(result_set.json),
+                         [{'col1': 'n1', 'col2': expected}])
+
+    def test_ragged_rows(self):
+        q = Query('some_table', ['col1', 'col2'])
+        result_set = QueryResultSet(q, col_types={'col2': 'int'})
+        result_set.update('my-monitor01', 'n1;1\nn2\nn3;3;extra\n', None)
+
+        self.assertEqual(result_set.lists,
+                         [['my-monitor01', 'n1', 1],
+                          ['my-monitor01', 'n2'],
+                          ['my-monitor01', 'n3', 3]])
+
+    def test_to_sqlite_times(self):
+        q = Query('some_table', ['col1'], omit_monitor_column=True)
+        result_set = QueryResultSet(q, col_types={'col1': 'time'})
+        result_set.update('my-monitor01', '1418675988\n1418675987\n', None)
+        expected = [(unicode(row[0].isoformat(' ')),)
+                    for row in result_set.lists]
+
+        db = result_set.to_sqlite()
+        self.assertEqual(db.execute('SELECT * FROM some_table').fetchall(),
+                         expected)
+
+        result_set.time_format = 'stamp'
+        db = result_set.to_sqlite()
+        self.assertEqual(db.execute('SELECT * FROM some_table').fetchall(),
+                         [(1418675988.0,), (1418675987.0,)])
+
+    def test_named_tuple_class_reused(self):
+        self.result_set.update(**self.monitor1)
+        first = self.result_set.named_tuples[0]
+        second = self.result_set.named_tuples[0]
+        self.assertIs(type(first), type(second))
+        self.assertEqual(first, second)
+
+    def test_add(self):
+        self.result_set.update(**self.monitor1)
+        other = QueryResultSet(self.q)
+        other.update(**self.monitor2)
+        other.update('my-monitor01', 'col1;col2;col3\nx1;x2;x3\n', None)
+
+        combined = self.result_set + other
+        self.assertEqual(sorted(combined.results),
+                         ['my-monitor01', 'my-monitor02'])
+        self.assertEqual(combined.lists, [['my-monitor01', 'x1', 'x2', 'x3']])
+        self.assertEqual(combined.errors,
+                         {'my-monitor02': 'my-monitor02 did not respond'})
+
+        self.assertRaises(TypeError, self.result_set.__add__,
+                          QueryResultSet(Query('other_table')))
+
+    def test_len(self):
+        self.assertEqual(len(self.result_set), 0)
+        self.result_set.update(**self.monitor1)
+        self.result_set.update(**self.monitor2)
+        self.result_set.update('my-monitor03', 'col1;col2;col3\na;b;c\nd;e;f',
+                               None)
+        self.assertEqual(len(self.result_set), 3)
+        self.assertEqual(len(self.result_set), len(self.result_set.lists))
+
+        q = Query('some_table', ['col1'])
+        result_set = QueryResultSet(q)
+        result_set.update('my-monitor01', 'a\nb\n', None)
+        self.assertEqual(len(result_set), 2)